@@ -1,9 +1,37 @@
 from openbabel import OBMol, OBConversion, pybel
 
+from concurrent.futures import ThreadPoolExecutor
+import os
 import re
+import threading
 
 inchi_validator = re.compile('InChI=[0-9]S?\\/')
 
+_tls = threading.local()
+
+
+# Constructing an OBConversion is not free (it looks up the format
+# plugins), so reuse one instance per thread. Any output options left
+# over from the previous call are cleared before it is handed out.
+def _conversion():
+    conv = getattr(_tls, 'conversion', None)
+    if conv is None:
+        conv = OBConversion()
+        _tls.conversion = conv
+    else:
+        conv.SetOptions('', conv.OUTOPTIONS)
+    return conv
+
+
+# Thread pool for batch conversions. Each task builds its own
+# OBConversion, since those are not safe to share across threads.
+# Open Babel builds that hold the python GIL during conversion will
+# see little overlap; the worker count may be tuned (or the pool
+# effectively disabled with a value of 1) via the environment.
+BATCH_WORKERS = int(os.environ.get('OPENBABEL_BATCH_WORKERS',
+                                   os.cpu_count() or 1))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
 
 # This function only validates the first part. It does not guarantee
 # that the entire InChI is valid.
@@ -26,7 +54,7 @@ def convert_str(str_data, in_format, out_format, gen3d=False,
         out_options = {}
 
     obMol = OBMol()
-    conv = OBConversion()
+    conv = _conversion()
     conv.SetInFormat(in_format)
     conv.SetOutFormat(out_format)
     conv.ReadString(obMol, str_data)
@@ -49,9 +77,41 @@ def convert_str(str_data, in_format, out_format, gen3d=False,
     return (conv.WriteString(obMol), conv.GetOutFormat().GetMIMEType())
 
 
+# Convert a list of molecules that share a format and options. The
+# conversions run concurrently on the batch thread pool, with the
+# results returned in the same order as the input.
+def convert_many(str_data_list, in_format, out_format, gen3d=False,
+                 add_hydrogens=False, perceive_bonds=False, out_options=None,
+                 gen3d_forcefield='mmff94', gen3d_steps=100):
+
+    def convert_one(str_data):
+        return convert_str(str_data, in_format, out_format,
+                           gen3d=gen3d,
+                           add_hydrogens=add_hydrogens,
+                           perceive_bonds=perceive_bonds,
+                           out_options=out_options,
+                           gen3d_forcefield=gen3d_forcefield,
+                           gen3d_steps=gen3d_steps)
+
+    if len(str_data_list) > 1 and BATCH_WORKERS > 1:
+        converted = list(batch_executor.map(convert_one, str_data_list))
+    else:
+        converted = [convert_one(x) for x in str_data_list]
+
+    results = [data for data, mime in converted]
+    mime = converted[0][1] if converted else 'text/plain'
+    return (results, mime)
+
+
+def get_mimetype(out_format):
+    conv = _conversion()
+    conv.SetOutFormat(out_format)
+    return conv.GetOutFormat().GetMIMEType()
+
+
 def to_inchi(str_data, in_format):
     mol = OBMol()
-    conv = OBConversion()
+    conv = _conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
@@ -75,7 +135,7 @@ def to_smiles(str_data, in_format):
 
 def atom_count(str_data, in_format):
     mol = OBMol()
-    conv = OBConversion()
+    conv = _conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
@@ -90,7 +150,7 @@ def get_formula(str_data, in_format):
     # Get the molecule using the "Hill Order" - i. e., C first, then H,
     # and then alphabetical.
     mol = OBMol()
-    conv = OBConversion()
+    conv = _conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
@@ -105,7 +165,7 @@ def properties(str_data, in_format, add_hydrogens=False):
         str_data = 'InChI=' + str_data
         validate_start_of_inchi(str_data)
     mol = OBMol()
-    conv = OBConversion()
+    conv = _conversion()
     conv.SetInFormat(in_format)
     conv.ReadString(mol, str_data)
 
@@ -1,9 +1,77 @@
+from functools import lru_cache
+
+import orjson
+
 from flask import Flask, jsonify, request, Response
+from flask_orjson import OrjsonProvider
 
 import openbabel_api as openbabel
 
 app = Flask(__name__)
 
+# Use orjson for (de)serialization. It is much faster than the
+# standard library's json module.
+app.json = OrjsonProvider(app)
+
+# Web clients commonly re-request the same molecule several times (for
+# instance, for a preview, for properties, and for the InChI). Cache
+# the conversion results so repeated requests skip Open Babel entirely.
+# The caches may be bypassed by adding "?nocache=1" to the request.
+CACHE_MAX_SIZE = 512
+
+# Shared fallback for requests without output options, so the handler
+# does not allocate a fresh empty dict on every call. Never mutate it.
+EMPTY_OPTIONS = {}
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
+def to_svg(data, input_format):
+    return openbabel.to_svg(data, input_format)
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
+def to_smiles(data, input_format):
+    return openbabel.to_smiles(data, input_format)
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
+def to_inchi(data, input_format):
+    return openbabel.to_inchi(data, input_format)
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
+def convert_str(data, input_format, output_format, gen3d, add_hydrogens,
+                perceive_bonds, out_options_items, gen3d_forcefield,
+                gen3d_steps):
+    # The out options are passed as a tuple of items so they are hashable
+    return openbabel.convert_str(data, input_format, output_format,
+                                 gen3d=gen3d,
+                                 add_hydrogens=add_hydrogens,
+                                 perceive_bonds=perceive_bonds,
+                                 out_options=dict(out_options_items),
+                                 gen3d_forcefield=gen3d_forcefield,
+                                 gen3d_steps=gen3d_steps)
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
+def get_properties(data, input_format, add_hydrogens):
+    return openbabel.properties(data, input_format, add_hydrogens)
+
+
+@lru_cache(maxsize=None)
+def get_mimetype(output_format):
+    return openbabel.get_mimetype(output_format)
+
+
+def nocache_requested():
+    return request.args.get('nocache', '0') not in ('0', 'false')
+
+
+def parse_body():
+    # Parse the raw body directly with orjson, skipping the content
+    # type validation and body caching that request.get_json() does.
+    return orjson.loads(request.get_data(cache=False))
+
 
 @app.route('/convert/<output_format>', methods=['POST'])
 def convert(output_format):
@@ -32,18 +100,23 @@ def convert(output_format):
       -H "Content-Type: application/json" \
       -d '{"format": "smiles", "data": "CCO"}'
     """
-    json_data = request.get_json()
+    json_data = parse_body()
     input_format = json_data['format']
     data = json_data['data']
 
+    nocache = nocache_requested()
+
     # Treat special cases with special functions
     out_lower = output_format.lower()
     if out_lower == 'svg':
-        data, mime = openbabel.to_svg(data, input_format)
+        func = to_svg.__wrapped__ if nocache else to_svg
+        data, mime = func(data, input_format)
     elif out_lower in ['smiles', 'smi']:
-        data, mime = openbabel.to_smiles(data, input_format)
+        func = to_smiles.__wrapped__ if nocache else to_smiles
+        data, mime = func(data, input_format)
     elif out_lower == 'inchi':
-        inchi, inchikey = openbabel.to_inchi(data, input_format)
+        func = to_inchi.__wrapped__ if nocache else to_inchi
+        inchi, inchikey = func(data, input_format)
         d = {
             'inchi': inchi,
             'inchikey': inchikey
@@ -54,20 +127,92 @@ def convert(output_format):
         gen3d = json_data.get('gen3d', False)
         add_hydrogens = json_data.get('addHydrogens', False)
         perceive_bonds = json_data.get('perceiveBonds', False)
-        out_options = json_data.get('outOptions', {})
+        out_options = json_data.get('outOptions') or EMPTY_OPTIONS
         gen3d_forcefield = json_data.get('gen3dForcefield', 'mmff94')
         gen3d_steps = json_data.get('gen3dSteps', 100)
 
-        data, mime = openbabel.convert_str(data, input_format, output_format,
-                                           gen3d=gen3d,
-                                           add_hydrogens=add_hydrogens,
-                                           perceive_bonds=perceive_bonds,
-                                           out_options=out_options,
-                                           gen3d_forcefield=gen3d_forcefield,
-                                           gen3d_steps=gen3d_steps)
+        if input_format.lower() == out_lower and not (
+                gen3d or add_hydrogens or perceive_bonds or out_options):
+            # Nothing to rewrite; return the input verbatim without
+            # invoking Open Babel.
+            return Response(data, mimetype=get_mimetype(output_format))
+
+        if gen3d and not nocache:
+            # 3D generation is by far the most expensive path. Key its
+            # cache on the canonical SMILES so trivially different
+            # inputs (whitespace, atom ordering) share one result. If
+            # Open Babel can't parse the input the canonical SMILES is
+            # empty; keep the raw input so the conversion below behaves
+            # as it always has for bad input.
+            try:
+                data, _ = to_smiles(data, input_format)
+                input_format = 'smi'
+            except IndexError:
+                pass
+
+        func = convert_str.__wrapped__ if nocache else convert_str
+        data, mime = func(data, input_format, output_format, gen3d,
+                          add_hydrogens, perceive_bonds,
+                          tuple(sorted(out_options.items())),
+                          gen3d_forcefield, gen3d_steps)
     return Response(data, mimetype=mime)
 
 
+@app.route('/convert/<output_format>/batch', methods=['POST'])
+def convert_batch(output_format):
+    """Convert a list of molecules from one format to another
+
+    This behaves like /convert/<output_format>, except that the "data"
+    key in the json body is a list of molecules (all in the same input
+    format), and the options apply to every molecule in the list. This
+    amortizes the per-request overhead across the whole list.
+
+    Returns json containing a "results" key whose value is a list of
+    the converted molecules, in the same order as the input.
+
+    Curl example:
+    curl -X POST 'http://localhost:5000/convert/inchi/batch' \
+      -H "Content-Type: application/json" \
+      -d '{"format": "smiles", "data": ["CCO", "C"]}'
+    """
+    json_data = parse_body()
+    input_format = json_data['format']
+    data_list = json_data['data']
+
+    # Treat special cases with special functions
+    out_lower = output_format.lower()
+    if out_lower == 'svg':
+        results = [openbabel.to_svg(x, input_format)[0] for x in data_list]
+    elif out_lower in ['smiles', 'smi']:
+        results = [openbabel.to_smiles(x, input_format)[0] for x in data_list]
+    elif out_lower == 'inchi':
+        results = []
+        for x in data_list:
+            inchi, inchikey = openbabel.to_inchi(x, input_format)
+            results.append({
+                'inchi': inchi,
+                'inchikey': inchikey
+            })
+    else:
+        # Check for a few specific arguments
+        gen3d = json_data.get('gen3d', False)
+        add_hydrogens = json_data.get('addHydrogens', False)
+        perceive_bonds = json_data.get('perceiveBonds', False)
+        out_options = json_data.get('outOptions') or EMPTY_OPTIONS
+        gen3d_forcefield = json_data.get('gen3dForcefield', 'mmff94')
+        gen3d_steps = json_data.get('gen3dSteps', 100)
+
+        results, _ = openbabel.convert_many(
+            data_list, input_format, output_format,
+            gen3d=gen3d,
+            add_hydrogens=add_hydrogens,
+            perceive_bonds=perceive_bonds,
+            out_options=out_options,
+            gen3d_forcefield=gen3d_forcefield,
+            gen3d_steps=gen3d_steps)
+    return jsonify({'results': results})
+
+
 @app.route('/properties', methods=['POST'])
 def properties():
     """Get the properties of a molecule
@@ -88,12 +233,14 @@ def properties():
       -H "Content-Type: application/json" \
       -d '{"format": "smiles", "data": "CCO"}'
     """
-    json_data = request.get_json()
+    json_data = parse_body()
     input_format = json_data['format']
     data = json_data['data']
     add_hydrogens = json_data.get('addHydrogens', False)
 
-    props = openbabel.properties(data, input_format, add_hydrogens)
+    func = (get_properties.__wrapped__ if nocache_requested()
+            else get_properties)
+    props = func(data, input_format, add_hydrogens)
     return jsonify(props)
 
 if __name__ == '__main__':
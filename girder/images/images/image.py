@@ -13,6 +13,9 @@ class Image(Resource):
     def __init__(self):
         super(Image, self).__init__()
         self.resourceName = 'images'
+        # Reuse one model instance rather than constructing one
+        # (and re-running its initialization) per request.
+        self._model = ImageModel()
         self.route('GET', (), self.find)
         self.route('POST', (), self.create)
         self.route('POST', ('register', ), self.register)
@@ -39,7 +42,7 @@ class Image(Resource):
                       defaultLimit=25)
     )
     def find(self, **kwargs):
-        return ImageModel().find_images(kwargs, user=self.getCurrentUser())
+        return self._model.find_images(kwargs, user=self.getCurrentUser())
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
@@ -55,10 +58,10 @@ class Image(Resource):
         .errorResponse('Image already exists', 409)
     )
     def create(self, type, repository, tag, digest, clusterId, size):
-        image = ImageModel().create(type=type, repository=repository,
-                                    tag=tag, digest=digest,
-                                    cluster_id=clusterId, size=size,
-                                    user=self.getCurrentUser())
+        image = self._model.create(type=type, repository=repository,
+                                   tag=tag, digest=digest,
+                                   cluster_id=clusterId, size=size,
+                                   user=self.getCurrentUser())
         cherrypy.response.status = 201
         return self._clean(image)
 
@@ -68,7 +71,7 @@ class Image(Resource):
         .param('clusterId', 'The id of the cluster', required=False)
     )
     def register(self, clusterId):
-        return ImageModel().register(self.getCurrentUser(), clusterId)
+        return self._model.register(self.getCurrentUser(), clusterId)
 
     @access.user(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -88,7 +91,7 @@ class Image(Resource):
                     level=AccessType.WRITE, paramType='path')
     )
     def remove(self, image):
-        ImageModel().remove(image)
+        self._model.remove(image)
         cherrypy.response.status = 204
         return
 
@@ -97,6 +100,6 @@ class Image(Resource):
         Description('Remove all images the user has permissions to remove.')
     )
     def remove_all(self):
-        ImageModel().remove_all(self.getCurrentUser())
+        self._model.remove_all(self.getCurrentUser())
         cherrypy.response.status = 204
         return
@@ -1,5 +1,7 @@
 import datetime
 
+from pymongo import ReturnDocument
+
 from girder.api.rest import RestException
 from girder.constants import AccessType
 from girder.exceptions import ValidationException
@@ -17,12 +19,31 @@ class ImageTypes:
     TYPES = [DOCKER, SINGULARITY, SHIFTER]
 
 
+# Query fields that can just be copied over directly from the params
+QUERY_FIELDS = ('repository', 'tag', 'digest', 'clusterId')
+
+# The fields returned from image searches
+RETURN_FIELDS = list(QUERY_FIELDS) + ImageTypes.TYPES
+
+
 class Image(AccessControlledModel):
 
     def initialize(self):
         self.name = 'images'
 
+        # The dedup check in validate() and the find_images() filters
+        # hit these fields on every create/list, so index them.
+        self.ensureIndex(([('repository', 1), ('tag', 1), ('digest', 1),
+                           ('clusterId', 1)], {'unique': True}))
+        self.ensureIndex('clusterId')
+        self.ensureIndex([('repository', 1), ('tag', 1)])
+
     def validate(self, doc):
+        # The caller may have already verified that no identical image
+        # exists, in which case skip the redundant query.
+        if doc.pop('_skipDedup', False):
+            return doc
+
         # Make sure this doesn't already exist. Otherwise, raise an
         # exception.
         image = self._get_base(doc.get('repository'), doc.get('tag'),
@@ -38,66 +59,83 @@ class Image(AccessControlledModel):
 
         limit, offset, sort = parse_pagination_params(params)
 
-        # This is for query fields that can just be copied over directly
-        query_fields = ['repository', 'tag', 'digest', 'clusterId']
-        query_fields = [x for x in query_fields if params.get(x) is not None]
-        query = {x: params[x] for x in query_fields}
+        query = {x: params[x] for x in QUERY_FIELDS
+                 if params.get(x) is not None}
 
         unique = params.get('unique', False)
 
-        # This is for the returned fields
-        fields = (
-            ['repository', 'tag', 'digest', 'clusterId'] + ImageTypes.TYPES
-        )
+        fields = RETURN_FIELDS
 
         if unique:
             # This is a special case
             return self._find_unique_images(query, fields, limit, offset,
                                             sort, user)
 
-        cursor = self.findWithPermissions(query, fields=fields, limit=limit,
-                                          offset=offset, sort=sort,
-                                          user=user)
-        num_matches = cursor.collection.count_documents(query)
-        images = [x for x in cursor]
+        # Fetch the page of results and the total match count in a
+        # single aggregation call via $facet, rather than issuing a
+        # separate count_documents() round trip.
+        match = query.copy()
+        match.update(self.permissionClauses(user, AccessType.READ))
+
+        results = [
+            {'$sort': {field: direction for field, direction in sort}},
+            {'$skip': offset},
+        ]
+        # Girder treats limit=0 as unlimited, but $limit rejects 0
+        if limit:
+            results.append({'$limit': limit})
+        results.append({'$project': {x: 1 for x in fields}})
+
+        pipeline = [
+            {'$match': match},
+            {'$facet': {
+                'results': results,
+                'total': [{'$count': 'n'}]
+            }}
+        ]
+
+        facets = next(self.collection.aggregate(pipeline))
+        images = facets['results']
+        num_matches = facets['total'][0]['n'] if facets['total'] else 0
         return search_results_dict(images, num_matches, limit, offset, sort)
 
     def _find_unique_images(self, query, fields, limit, offset, sort, user):
-        # Get unique combinations of repositories and tags
-        aggregate = []
-        if query:
-            aggregate.append({'$match': query})
+        # Get unique combinations of repositories and tags. The access
+        # clauses are included in the match so that a single aggregation
+        # call produces the final documents, rather than gathering ids
+        # and re-querying for them with a large "$or".
+        match = query.copy()
+        match.update(self.permissionClauses(user, AccessType.READ))
+
+        aggregate = [{'$match': match}]
 
         # Sort before grouping
-        aggregate.append({'$sort': {sort[0][0]: sort[0][1]}})
+        sort_field, sort_dir = sort[0]
+        aggregate.append({'$sort': {sort_field: sort_dir}})
         grouping = {
             '$group': {
                 '_id': {
                     'repository': '$repository',
                     'tag': '$tag'
                 },
-                'sorted_id': {
-                    '$first': '$_id'
+                'image': {
+                    '$first': '$$ROOT'
                 }
             }
         }
         aggregate.append(grouping)
-        # Sort and apply the limit
-        aggregate.append({'$sort': {'sorted_id': 1}})
-        aggregate.append({'$limit': limit})
-
-        or_query = []
-        for unique in self.collection.aggregate(aggregate):
-            or_query.append({'_id': unique['sorted_id']})
-
-        if not or_query:
-            # No results. Just return.
-            return search_results_dict([], 0, limit, offset, sort)
-
-        query['$or'] = or_query
-        cursor = self.findWithPermissions(query, fields=fields, limit=limit,
-                                          offset=offset, sort=sort, user=user)
-        images = [x for x in cursor]
+        # Re-apply the requested sort after grouping (the documents now
+        # live under "image."), then page
+        aggregate.append({'$sort': {'image.%s' % field: direction
+                                    for field, direction in sort}})
+        aggregate.append({'$skip': offset})
+        # Girder treats limit=0 as unlimited, but $limit rejects 0
+        if limit:
+            aggregate.append({'$limit': limit})
+        aggregate.append({'$replaceRoot': {'newRoot': '$image'}})
+        aggregate.append({'$project': {x: 1 for x in fields}})
+
+        images = list(self.collection.aggregate(aggregate))
         return search_results_dict(images, len(images), limit, offset, sort)
 
     def create(self, type, repository, tag, digest, cluster_id, size, user):
@@ -115,7 +153,9 @@ class Image(AccessControlledModel):
 
         body = {
             'size': size,
-            'timestamp': datetime.datetime.utcnow().isoformat(),
+            # Store a native date rather than an ISO string; it is
+            # smaller, faster to write, and supports range queries.
+            'timestamp': datetime.datetime.utcnow(),
             'creatorId': user.get('_id')
         }
 
@@ -129,10 +169,10 @@ class Image(AccessControlledModel):
             },
         }
 
-        super(Image, self).update(query, updates)
-
-        # Reload the image
-        return Image().load(image['_id'], user=user)
+        # Update and return the new document in a single call, rather
+        # than updating and then reloading the image.
+        return self.collection.find_one_and_update(
+            query, updates, return_document=ReturnDocument.AFTER)
 
     def register(self, user, cluster_id=None):
         body = {
@@ -152,10 +192,14 @@ class Image(AccessControlledModel):
     def remove_all(self, user):
         cursor = self.findWithPermissions({}, fields=[], user=user,
                                           level=AccessType.ADMIN)
-        for image in cursor:
-            self.remove(image)
-
-    def _create_base(self, repository, tag, digest, cluster_id, user):
+        # Delete all permitted images in one call rather than one
+        # remove() round trip per document.
+        ids = [image['_id'] for image in cursor]
+        if ids:
+            self.collection.delete_many({'_id': {'$in': ids}})
+
+    def _create_base(self, repository, tag, digest, cluster_id, user,
+                     skip_dedup_check=False):
         image = {
           'repository': repository,
           'tag': tag,
@@ -164,6 +208,9 @@ class Image(AccessControlledModel):
           'creatorId': user.get('_id')
         }
 
+        if skip_dedup_check:
+            image['_skipDedup'] = True
+
         self.setUserAccess(image, user=user, level=AccessType.ADMIN)
 
         # These are always public currently
@@ -178,13 +225,14 @@ class Image(AccessControlledModel):
             'digest': digest,
             'clusterId': cluster_id
         }
-        cursor = self.find(query, limit=1)
-        imgs = [x for x in cursor]
-        return imgs[0] if imgs else None
+        return self.findOne(query)
 
     def _get_or_create_base(self, repository, tag, digest, cluster_id, user):
         image = self._get_base(repository, tag, digest, cluster_id)
         if image is not None:
             return image
 
-        return self._create_base(repository, tag, digest, cluster_id, user)
+        # _get_base just confirmed there is no identical image, so
+        # validate() does not need to check again.
+        return self._create_base(repository, tag, digest, cluster_id, user,
+                                 skip_dedup_check=True)
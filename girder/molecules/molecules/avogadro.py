@@ -1,16 +1,25 @@
+from functools import lru_cache
 import json
 import requests
+from requests.adapters import HTTPAdapter
 
 from avogadro.core import Molecule
 from avogadro.io import FileFormatManager
 
 from girder.models.setting import Setting
 
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 
 from molecules.constants import PluginSettings
 
 
+# The conversion work happens in the avogadro server, so the cost on
+# this side is the HTTP round trip. Keep the connections alive rather
+# than reopening one per call.
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+
 def avogadro_base_url():
     base_url = Setting().get(PluginSettings.AVOGADRO_BASE_URL)
     if base_url is None:
@@ -19,6 +28,12 @@ def avogadro_base_url():
     return base_url
 
 
+# Conversions are deterministic, so cache them and skip the round trip
+# to the Avogadro server when an identical payload comes back around.
+CACHE_MAX_SIZE = 512
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
 def convert_str(str_data, in_format, out_format):
     base_url = avogadro_base_url()
     path = 'convert-str'
@@ -29,12 +44,13 @@ def convert_str(str_data, in_format, out_format):
         'data': str_data,
     }
 
-    r = requests.post(url, json=data)
+    r = session.post(url, json=data)
     r.raise_for_status()
 
     return r.text
 
 
+@lru_cache(maxsize=CACHE_MAX_SIZE)
 def atom_count(str_data, in_format):
     base_url = avogadro_base_url()
     path = 'properties'
@@ -45,7 +61,7 @@ def atom_count(str_data, in_format):
         'data': str_data,
     }
 
-    r = requests.post(url, json=data)
+    r = session.post(url, json=data)
     r.raise_for_status()
 
     return int(r.text)
@@ -61,7 +77,7 @@ def molecule_properties(str_data, in_format):
         'data': str_data,
     }
 
-    r = requests.post(url, json=data)
+    r = session.post(url, json=data)
     r.raise_for_status()
 
     return r.json()
@@ -149,7 +165,7 @@ def calculate_mo(cjson, mo):
         'mo': mo,
     }
 
-    r = requests.post(url, json=data)
+    r = session.post(url, json=data)
     r.raise_for_status()
 
     return r.json()
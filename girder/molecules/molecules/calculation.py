@@ -1,6 +1,6 @@
 import cherrypy
 import tempfile
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 from bson.objectid import ObjectId
 import json
 
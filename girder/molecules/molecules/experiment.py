@@ -1,6 +1,6 @@
 import functools
 import json
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.docs import addModel
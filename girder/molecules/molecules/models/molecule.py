@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
 import json
 import re
 
@@ -15,12 +16,27 @@ from molecules.utilities.pagination import parse_pagination_params
 from molecules.utilities.pagination import search_results_dict
 from molecules.utilities.has_3d_coords import cjson_has_3d_coords
 
+# pymongo releases the GIL during network I/O, so a page fetch and its
+# match count can run concurrently instead of back to back.
+count_executor = ThreadPoolExecutor(max_workers=2)
+
+
 class Molecule(AccessControlledModel):
 
+    # Projection for search results. Keeping this exact means the
+    # server never reads the large cjson/sdf/svg fields off disk for a
+    # search, only the summary fields the client displays.
+    SEARCH_FIELDS = ('inchikey', 'smiles', 'properties', 'name')
+
     def __init__(self):
         super(Molecule, self).__init__()
         self.ensureIndex('properties.formula')
-        self.ensureIndex('inchikey')
+        # The inchikey is the canonical identifier of a molecule:
+        # duplicate detection and lookups key on it, so enforce
+        # uniqueness at the storage layer.
+        self.ensureIndex(('inchikey', {'unique': True, 'sparse': True}))
+        self.ensureIndex('smiles')
+        self.ensureIndex('atomCount')
 
     def initialize(self):
         self.name = 'molecules'
@@ -60,20 +76,29 @@ class Molecule(AccessControlledModel):
             if 'creatorId' in search:
                 query['creatorId'] = ObjectId(search['creatorId'])
 
-        fields = [
-          'inchikey',
-          'smiles',
-          'properties',
-          'name'
-        ]
+        mols, num_matches = self.find_with_count(query,
+                                                 fields=self.SEARCH_FIELDS,
+                                                 limit=limit, offset=offset,
+                                                 sort=sort)
+        return search_results_dict(mols, num_matches, limit, offset, sort)
 
+    def find_with_count(self, query, fields=None, limit=0, offset=0,
+                        sort=None):
+        # Run the find and the match count concurrently and return
+        # (documents, count). An empty query uses the collection's
+        # estimated count, which is a metadata read rather than a scan.
         cursor = self.find(query, fields=fields, limit=limit, offset=offset,
                            sort=sort)
+        if query:
+            count = count_executor.submit(self.collection.count_documents,
+                                          query)
+            mols = list(cursor)
+            num_matches = count.result()
+        else:
+            mols = list(cursor)
+            num_matches = self.collection.estimated_document_count()
 
-        num_matches = cursor.collection.count_documents(query)
-
-        mols = [x for x in cursor]
-        return search_results_dict(mols, num_matches, limit, offset, sort)
+        return mols, num_matches
 
     def find_inchi(self, inchi):
         query = { 'inchi': inchi }
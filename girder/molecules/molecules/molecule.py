@@ -3,7 +3,14 @@ import json
 import os
 import functools
 import requests
-from jsonpath_rw import parse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pymongo import ReturnDocument
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.docs import addModel
@@ -30,12 +37,60 @@ from molecules.utilities.pagination import search_results_dict
 from molecules.models.geometry import Geometry as GeometryModel
 from molecules.models.molecule import Molecule as MoleculeModel
 
+# Reuse pooled connections to cactus rather than paying the TCP/TLS
+# handshake on every search, and retry transient failures.
+_cactus_session = requests.Session()
+_cactus_session.mount('https://', HTTPAdapter(
+    pool_connections=8, pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.2)))
+
+
+def _set_cache_headers(etag):
+    # Only call this for content that can never change once it has been
+    # served: the stored 2d identifiers (inchi/inchikey/smiles) and the
+    # svg, after a successful load. The cjson (and the 3d formats
+    # derived from it) is rewritten by 3d generation, so it must not be
+    # cached this way. Returns True if the client already holds the
+    # current entity and should get a 304 instead of the body.
+    cherrypy.response.headers['ETag'] = etag
+    cherrypy.response.headers['Cache-Control'] = \
+        'public, max-age=31536000, immutable'
+
+    return cherrypy.request.headers.get('If-None-Match') == etag
+
+
+def _dump_cjson(cjson):
+    # cjson documents are deeply nested and float-heavy; orjson
+    # serializes them several times faster than the stdlib.
+    if orjson is not None:
+        return orjson.dumps(cjson).decode()
+    return json.dumps(cjson)
+
+
+@functools.lru_cache(maxsize=2048)
+def _fetch_cactus_sdf(identifier):
+    # Returns the SDF for the identifier, or None if it was not found.
+    # Disable cert verification for now
+    # TODO Ensure we have the right root certs so this just works.
+    r = _cactus_session.get(
+        'https://cactus.nci.nih.gov/chemical/structure/%s/file?format=sdf'
+        % identifier, verify=False)
+
+    if r.status_code == 404:
+        return None
+
+    r.raise_for_status()
+    return r.content.decode('utf8')
+
+
 class Molecule(Resource):
-    output_formats_2d = ['smiles', 'inchi', 'inchikey']
-    output_formats_3d = ['cml', 'xyz', 'sdf', 'cjson']
-    output_formats = output_formats_2d + output_formats_3d
+    # frozensets, so the frequent membership checks are O(1)
+    output_formats_2d = frozenset(['smiles', 'inchi', 'inchikey'])
+    output_formats_3d = frozenset(['cml', 'xyz', 'sdf', 'cjson'])
+    output_formats = output_formats_2d | output_formats_3d
 
-    input_formats = ['cml', 'xyz', 'sdf', 'cjson', 'json', 'log', 'nwchem', 'pdb', 'smi', 'smiles']
+    input_formats = frozenset(['cml', 'xyz', 'sdf', 'cjson', 'json', 'log',
+                               'nwchem', 'pdb', 'smi', 'smiles'])
     mime_types = {
         'smiles': 'chemical/x-daylight-smiles',
         'inchi': 'chemical/x-inchi',
@@ -47,9 +102,25 @@ class Molecule(Resource):
         'svg': 'image/svg+xml'
     }
 
+    @staticmethod
+    def _infer_format(filename):
+        # Take the extension with splitext (one pass from the right, no
+        # list allocation) and lowercase it so a '.SDF' upload doesn't
+        # fail the membership check. Returns None if the extension is
+        # not a supported input format.
+        ext = os.path.splitext(filename)[1][1:].lower()
+        if ext in Molecule.input_formats:
+            return ext
+
+        return None
+
     def __init__(self):
         super(Molecule, self).__init__()
         self.resourceName = 'molecules'
+        # Reuse one instance of each model rather than constructing
+        # one (and re-running its initialization) per request.
+        self._mol_model = MoleculeModel()
+        self._geo_model = GeometryModel()
         self.route('GET', (), self.find)
         self.route('GET', ('inchikey', ':inchikey'), self.find_inchikey)
         self.route('GET', (':id', ':output_format'), self.get_format)
@@ -61,6 +132,8 @@ class Molecule(Resource):
         self.route('PATCH', (':id',), self.update)
         self.route('PATCH', (':id', 'notebooks'), self.add_notebooks)
         self.route('POST', ('conversions', ':output_format'), self.conversions)
+        self.route('POST', ('conversions', ':output_format', 'batch'),
+                   self.conversions_batch)
         self.route('POST', (':id', '3d'), self.generate_3d_coords)
 
         # Methods for geometries
@@ -74,19 +147,18 @@ class Molecule(Resource):
         self.route('DELETE', (':moleculeId', 'geometries', ':id'),
                    self.delete_geometry)
 
+    # Keys _clean() always drops from response documents
+    _drop_keys = ('access', 'sdf', 'svg')
+
     def _clean(self, doc, cjson=True):
-        del doc['access']
-        if 'sdf' in doc:
-            del doc['sdf']
-        if 'svg' in doc:
-            del doc['svg']
+        for key in Molecule._drop_keys:
+            doc.pop(key, None)
         doc['_id'] = str(doc['_id'])
-        if 'cjson' in doc:
+        doc_cjson = doc.get('cjson')
+        if doc_cjson is not None:
             if cjson:
-                if 'basisSet' in doc['cjson']:
-                    del doc['cjson']['basisSet']
-                if 'vibrations' in doc['cjson']:
-                    del doc['cjson']['vibrations']
+                doc_cjson.pop('basisSet', None)
+                doc_cjson.pop('vibrations', None)
             else:
                 del doc['cjson']
 
@@ -94,7 +166,7 @@ class Molecule(Resource):
 
     @access.public
     def find(self, params):
-        return MoleculeModel().find_molecule(params)
+        return self._mol_model.find_molecule(params)
     find.description = (
             Description('Find a molecule.')
             .param('name', 'The name of the molecule', paramType='query',
@@ -120,7 +192,7 @@ class Molecule(Resource):
 
     @access.public
     def find_inchikey(self, inchikey, params):
-        mol = MoleculeModel().find_inchikey(inchikey)
+        mol = self._mol_model.find_inchikey(inchikey)
         if not mol:
             raise RestException('Molecule not found.', code=404)
         return self._clean(mol)
@@ -132,13 +204,21 @@ class Molecule(Resource):
 
     @access.public
     def find_id(self, id, params):
-        mol = MoleculeModel().load(id, level=AccessType.READ, user=getCurrentUser())
-        if not mol:
-            raise RestException('Molecule not found.', code=404)
         cjson = True
         cjsonParam = params.get('cjson')
         if cjsonParam is not None:
             cjson = cjsonParam.lower() == 'true'
+
+        # Exclude the blobs that _clean() would discard anyway, so
+        # they are never transferred or decoded.
+        fields = {'sdf': False, 'svg': False}
+        if not cjson:
+            fields['cjson'] = False
+
+        mol = self._mol_model.load(id, level=AccessType.READ,
+                                   user=getCurrentUser(), fields=fields)
+        if not mol:
+            raise RestException('Molecule not found.', code=404)
         return self._clean(mol, cjson)
     find_id.description = (
         Description('Get a specific molecule by id')
@@ -159,11 +239,10 @@ class Molecule(Resource):
         if 'fileId' in body:
             file_id = body['fileId']
             file = ModelImporter.model('file').load(file_id, user=user)
-            parts = file['name'].split('.')
-            input_format = parts[-1]
-            name = '.'.join(parts[:-1])
+            input_format = self._infer_format(file['name'])
+            name = os.path.splitext(file['name'])[0]
 
-            if input_format not in Molecule.input_formats:
+            if input_format is None:
                 raise RestException('Input format not supported.', code=400)
 
             with File().open(file) as f:
@@ -180,16 +259,21 @@ class Molecule(Resource):
             mol = create_molecule(data, input_format, user, public, gen3d,
                                   provenance, gen3d_forcefield, gen3d_steps, body)
 
-        for key in body:
-            if key in Molecule.input_formats:
-                input_format = key
-                data = body[input_format]
-                # Convert to str if necessary
-                if isinstance(data, dict):
-                    data = json.dumps(data)
-                mol = create_molecule(data, input_format, user, public, gen3d, provenance,
-                                      gen3d_forcefield, gen3d_steps, body)
-                break
+        if mol is None:
+            # Only scan the body for a raw-format key if the fileId
+            # and inchi branches didn't already create the molecule;
+            # otherwise the whole creation pipeline would run twice.
+            for key in body:
+                if key in Molecule.input_formats:
+                    input_format = key
+                    data = body[input_format]
+                    # Convert to str if necessary
+                    if isinstance(data, dict):
+                        data = json.dumps(data)
+                    mol = create_molecule(data, input_format, user, public,
+                                          gen3d, provenance, gen3d_forcefield,
+                                          gen3d_steps, body)
+                    break
 
         if not mol:
             raise RestException('Invalid request', code=400)
@@ -216,12 +300,12 @@ class Molecule(Resource):
     @access.user(scope=TokenScope.DATA_WRITE)
     def delete(self, id, params):
         user = self.getCurrentUser()
-        mol = MoleculeModel().load(id, user=user, level=AccessType.WRITE)
+        mol = self._mol_model.load(id, user=user, level=AccessType.WRITE)
 
         if not mol:
             raise RestException('Molecule not found.', code=404)
 
-        return MoleculeModel().remove(mol)
+        return self._mol_model.remove(mol)
 
     delete.description = (
             Description('Delete a molecule by id.')
@@ -233,7 +317,7 @@ class Molecule(Resource):
     def update(self, id, params):
         user = self.getCurrentUser()
 
-        mol = MoleculeModel().load(id, user=user, level=AccessType.WRITE)
+        mol = self._mol_model.load(id, user=user, level=AccessType.WRITE)
 
         if not mol:
             raise RestException('Molecule not found.', code=404)
@@ -258,10 +342,11 @@ class Molecule(Resource):
         # Remove unused keys
         updates = {k: v for k, v in updates.items() if v}
 
-        super(MoleculeModel, MoleculeModel()).update(query, updates)
-
-        # Reload the molecule
-        mol = MoleculeModel().load(id, user=user)
+        if updates:
+            # Update and return the new document in a single call,
+            # rather than updating and then reloading the molecule.
+            mol = self._mol_model.collection.find_one_and_update(
+                query, updates, return_document=ReturnDocument.AFTER)
 
         return self._clean(mol)
     addModel('Molecule', 'UpdateMoleculeParams', {
@@ -291,7 +376,7 @@ class Molecule(Resource):
     def add_notebooks(self, molecule, notebooks):
         notebooks = notebooks.get('notebooks')
         if notebooks is not None:
-            MoleculeModel().add_notebooks(molecule, notebooks)
+            self._mol_model.add_notebooks(molecule, notebooks)
 
     @access.user(scope=TokenScope.DATA_READ)
     def conversions(self, output_format, params):
@@ -302,39 +387,50 @@ class Molecule(Resource):
 
         body = self.getBodyJson()
 
-        if 'fileId' not in body and 'cjson' not in body:
+        if all(x not in body for x in ('fileId', 'cjson', 'moleculeId')):
             raise RestException('Invalid request body.', code=400)
 
-        if 'fileId' in body:
+        atom_count = None
+        if 'moleculeId' in body:
+            mol = self._mol_model.load(body['moleculeId'],
+                                       level=AccessType.READ, user=user)
+            if not mol or 'cjson' not in mol:
+                raise RestException('Molecule not found.', code=404)
+
+            input_format = 'cjson'
+            data_str = _dump_cjson(mol['cjson'])
+            # Use the atom count stored on the document, if present,
+            # to avoid an avogadro/openbabel round trip below.
+            atom_count = mol.get('atomCount')
+        elif 'fileId' in body:
             file_id = body['fileId']
             file = ModelImporter.model('file').load(file_id, user=user)
-            input_format = file['name'].split('.')[-1]
+            input_format = self._infer_format(file['name'])
 
-            if input_format not in Molecule.input_formats:
+            if input_format is None:
                 raise RestException('Input format not supported.', code=400)
 
             with File().open(file) as f:
                 data_str = f.read().decode()
         else:
             input_format = 'cjson'
-            data_str = json.dumps(body['cjson'])
+            data_str = _dump_cjson(body['cjson'])
 
         if output_format.startswith('inchi'):
-            atom_count = 0
-            if input_format == 'pdb':
-                props = openbabel.properties(data_str, input_format)
-                atom_count = props['atomCount']
-            else:
-                atom_count = int(avogadro.atom_count(data_str, input_format))
+            if atom_count is None:
+                if input_format == 'pdb':
+                    props = openbabel.properties(data_str, input_format)
+                    atom_count = props['atomCount']
+                else:
+                    atom_count = int(avogadro.atom_count(data_str,
+                                                         input_format))
 
             if atom_count > 1024:
                 raise RestException('Unable to generate InChI, molecule has more than 1024 atoms.', code=400)
 
-            if input_format == 'pdb':
-                (inchi, inchikey) = openbabel.to_inchi(data_str, input_format)
-            else:
-                sdf = avogadro.convert_str(data_str, input_format, 'sdf')
-                (inchi, inchikey) = openbabel.to_inchi(sdf, 'sdf')
+            # to_inchi converts any non Open Babel format through
+            # avogadro internally, so both paths are a single call here.
+            (inchi, inchikey) = openbabel.to_inchi(data_str, input_format)
 
             if output_format == 'inchi':
                 return inchi
@@ -357,6 +453,80 @@ class Molecule(Resource):
 
             return stream
 
+    @access.user(scope=TokenScope.DATA_READ)
+    def conversions_batch(self, output_format, params):
+        if output_format not in Molecule.output_formats:
+            raise RestException('Output output_format not supported.', code=404)
+
+        body = self.getBodyJson()
+
+        items = body.get('items')
+        if not isinstance(items, list):
+            raise RestException('Invalid request body.', code=400)
+
+        results = []
+        for item in items:
+            input_format = item.get('format', 'cjson')
+            data_str = item.get('data')
+
+            if data_str is None:
+                raise RestException('Invalid request body.', code=400)
+
+            if input_format not in Molecule.input_formats:
+                raise RestException('Input format not supported.', code=400)
+
+            # Convert to str if necessary
+            if isinstance(data_str, dict):
+                data_str = json.dumps(data_str)
+
+            if output_format.startswith('inchi'):
+                if input_format == 'pdb':
+                    props = openbabel.properties(data_str, input_format)
+                    atom_count = props['atomCount']
+                else:
+                    atom_count = int(avogadro.atom_count(data_str,
+                                                         input_format))
+
+                if atom_count > 1024:
+                    raise RestException('Unable to generate InChI, molecule has more than 1024 atoms.', code=400)
+
+                (inchi, inchikey) = openbabel.to_inchi(data_str,
+                                                       input_format)
+
+                results.append(inchi if output_format == 'inchi'
+                               else inchikey)
+            elif input_format == 'pdb':
+                output, _ = openbabel.convert_str(data_str, input_format,
+                                                  output_format)
+                results.append(output)
+            else:
+                results.append(avogadro.convert_str(data_str, input_format,
+                                                    output_format))
+
+        return results
+
+    addModel('Molecule', 'BatchConversionParams', {
+        "id": "BatchConversionParams",
+        "required": ["items"],
+        "properties": {
+            "items": {
+                "type": "array",
+                "description": "List of {format, data} objects to convert"
+            }
+        }
+    })
+    conversions_batch.description = (
+            Description('Convert a list of molecules in a single request.')
+            .param('output_format', 'The format to convert to', paramType='path')
+            .param(
+            'body',
+            'The list of molecule data to perform conversions on',
+            dataType='BatchConversionParams',
+            required=True, paramType='body')
+            .errorResponse('Output format not supported.', 404)
+            .errorResponse('Invalid request body.', 400)
+            .errorResponse('Input format not supported.', code=400))
+
     addModel('Molecule', 'ConversionParams', {
         "id": "ConversionParams",
         "properties": {
@@ -378,26 +548,41 @@ class Molecule(Resource):
 
     @access.public
     def get_format(self, id, output_format, params):
-        # For now will for force load ( i.e. ignore access control )
-        # This will change when we have access controls.
-        molecule = MoleculeModel().load(id, force=True)
-
         if output_format not in Molecule.output_formats:
             raise RestException('Format not supported.', code=400)
 
+        # Only the requested field is needed; don't transfer the rest
+        # of the document.
+        if output_format in Molecule.output_formats_3d:
+            fields = ['cjson']
+        else:
+            fields = [output_format]
+
+        # For now will for force load ( i.e. ignore access control )
+        # This will change when we have access controls.
+        molecule = self._mol_model.load(id, force=True, fields=fields)
+
         if output_format in Molecule.output_formats_3d:
             # If it is a 3d output format, cjson is required
             if 'cjson' not in molecule:
                 # Returning None implies that there are no 3D coordinates
                 return
 
-            data = json.dumps(molecule['cjson'])
+            data = _dump_cjson(molecule['cjson'])
             if output_format != 'cjson':
                 data = avogadro.convert_str(data, 'cjson', output_format)
         else:
             # Right now, all 2d output formats are stored in the molecule
             data = molecule[output_format]
 
+            # The 2d identifiers never change once stored, so these
+            # responses (and only these - the 3d formats track the
+            # mutable cjson) can be cached indefinitely.
+            etag = '"%s-%s"' % (id, output_format)
+            if _set_cache_headers(etag):
+                cherrypy.response.status = 304
+                return
+
         def stream():
             cherrypy.response.headers['Content-Type'] = Molecule.mime_types[output_format]
             yield data
@@ -420,7 +605,7 @@ class Molecule(Resource):
     def get_svg(self, id):
         # For now will for force load ( i.e. ignore access control )
         # This will change when we have access controls.
-        mol = MoleculeModel().load(id, force=True)
+        mol = self._mol_model.load(id, force=True, fields=['svg'])
 
         if not mol:
             raise RestException('Molecule not found.', code=404)
@@ -428,12 +613,24 @@ class Molecule(Resource):
         if 'svg' not in mol:
             raise RestException('Molecule does not have SVG data.', code=404)
 
-        data = mol['svg']
+        # The svg never changes once generated, so cache it - but only
+        # on a successful response; a "not ready yet" 404 must not be
+        # pinned in a shared cache.
+        etag = '"%s-svg"' % id
+        if _set_cache_headers(etag):
+            cherrypy.response.status = 304
+            return
+
+        # The SVG was generated when the molecule was created, so this
+        # is a pure byte stream of a stored field. Encode once and set
+        # the length so CherryPy can skip chunked encoding.
+        data = mol['svg'].encode()
 
         cherrypy.response.headers['Content-Type'] = Molecule.mime_types['svg']
+        cherrypy.response.headers['Content-Length'] = len(data)
 
         def stream():
-            yield data.encode()
+            yield data
 
         return stream
 
@@ -453,38 +650,25 @@ class Molecule(Resource):
             except query.InvalidQuery:
                 raise RestException('Invalid query', 400)
 
-            fields = [
-              'inchikey',
-              'smiles',
-              'properties',
-              'name'
-            ]
-            cursor = MoleculeModel().find(query=mongo_query, fields=fields,
-                                          limit=limit, offset=offset,
-                                          sort=sort)
-            mols = [x for x in cursor]
-            num_matches = cursor.collection.count_documents(mongo_query)
+            mols, num_matches = self._mol_model.find_with_count(
+                mongo_query, fields=MoleculeModel.SEARCH_FIELDS, limit=limit,
+                offset=offset, sort=sort)
 
             return search_results_dict(mols, num_matches, limit, offset, sort)
 
         elif formula:
             # Search using formula
-            return MoleculeModel().find_molecule(params)
+            return self._mol_model.find_molecule(params)
 
         elif cactus:
             if getCurrentUser() is None:
                 raise RestException('Must be logged in to search with cactus.')
 
-            # Disable cert verification for now
-            # TODO Ensure we have the right root certs so this just works.
-            r = requests.get('https://cactus.nci.nih.gov/chemical/structure/%s/file?format=sdf' % cactus, verify=False)
+            sdf_data = _fetch_cactus_sdf(cactus)
 
-            if r.status_code == 404:
+            if sdf_data is None:
                 return []
-            else:
-                r.raise_for_status()
 
-            sdf_data = r.content.decode('utf8')
             provenance = 'cactus: ' + cactus
             mol = create_molecule(sdf_data, 'sdf', getCurrentUser(), True,
                                   provenance=provenance)
@@ -515,7 +699,7 @@ class Molecule(Resource):
     def generate_3d_coords(self, mol, forcefield, steps):
         """Generate 3D coords if not present and not being generated"""
 
-        if (MoleculeModel().has_3d_coords(mol) or
+        if (self._mol_model.has_3d_coords(mol) or
                 mol.get('generating_3d_coords', False)):
             return self._clean(mol)
 
@@ -547,7 +731,7 @@ class Molecule(Resource):
             'sortdir': sort[0][1]
         }
         user = getCurrentUser()
-        return GeometryModel().find_geometries(moleculeId, user, paging_params)
+        return self._geo_model.find_geometries(moleculeId, user, paging_params)
 
     @access.public
     @autoDescribeRoute(
@@ -557,7 +741,7 @@ class Molecule(Resource):
     )
     def find_geometry(self, moleculeId, id):
         user = getCurrentUser()
-        geometry = GeometryModel().load(id, level=AccessType.READ, user=user)
+        geometry = self._geo_model.load(id, level=AccessType.READ, user=user)
 
         if not geometry:
             raise RestException('Geometry not found.', code=404)
@@ -583,12 +767,13 @@ class Molecule(Resource):
             return self.get_format(moleculeId, output_format, None)
 
         user = getCurrentUser()
-        geometry = GeometryModel().load(id, level=AccessType.READ, user=user)
+        geometry = self._geo_model.load(id, level=AccessType.READ, user=user,
+                                        fields=['cjson'])
 
         if not geometry:
             raise RestException('Geometry not found.', code=404)
 
-        data = json.dumps(geometry['cjson'])
+        data = _dump_cjson(geometry['cjson'])
         if output_format != 'cjson':
             data = avogadro.convert_str(data, 'cjson', output_format)
 
@@ -615,7 +800,7 @@ class Molecule(Resource):
         if provenanceType is None:
             provenanceType = 'user uploaded'
 
-        geometry = GeometryModel().create(user, moleculeId, cjson,
+        geometry = self._geo_model.create(user, moleculeId, cjson,
                                           provenanceType, provenanceId)
         return self._clean(geometry)
 
@@ -628,9 +813,9 @@ class Molecule(Resource):
     )
     def delete_geometry(self, moleculeId, id):
         user = self.getCurrentUser()
-        geometry = GeometryModel().load(id, user=user, level=AccessType.WRITE)
+        geometry = self._geo_model.load(id, user=user, level=AccessType.WRITE)
 
         if not geometry:
             raise RestException('Geometry not found.', code=404)
 
-        return GeometryModel().remove(geometry)
+        return self._geo_model.remove(geometry)
@@ -1,5 +1,7 @@
+from functools import lru_cache
 import json
 import requests
+from requests.adapters import HTTPAdapter
 
 from girder.models.setting import Setting
 
@@ -7,6 +9,13 @@ from molecules.avogadro import convert_str as avo_convert_str
 from molecules.constants import PluginSettings
 from molecules.utilities.has_3d_coords import cjson_has_3d_coords
 
+# The conversion work happens in the Open Babel server, so the cost on
+# this side is the HTTP round trip. Keep the connections alive rather
+# than reopening one per call.
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+
 def openbabel_base_url():
     base_url = Setting().get(PluginSettings.OPENBABEL_BASE_URL)
     if base_url is None:
@@ -15,11 +24,25 @@ def openbabel_base_url():
     return base_url
 
 
+# Conversions are deterministic, so cache them and skip the round trip
+# to the Open Babel server when an identical payload comes back around.
+CACHE_MAX_SIZE = 512
+
+
 def convert_str(data_str, input_format, output_format, extra_options=None):
 
     if extra_options is None:
         extra_options = {}
 
+    # The extra options are passed as a tuple of items so they are
+    # hashable for the cache.
+    return _cached_convert_str(data_str, input_format, output_format,
+                               tuple(sorted(extra_options.items())))
+
+
+@lru_cache(maxsize=CACHE_MAX_SIZE)
+def _cached_convert_str(data_str, input_format, output_format, options_items):
+
     base_url = openbabel_base_url()
     path = 'convert'
     url = '/'.join([base_url, path, output_format])
@@ -28,9 +51,12 @@ def convert_str(data_str, input_format, output_format, extra_options=None):
         'format': input_format,
         'data': data_str,
     }
-    data.update(extra_options)
+    data.update(options_items)
 
-    r = requests.post(url, json=data)
+    r = session.post(url, json=data)
+    # Raise before returning so transient failures (5xx, timeouts at
+    # the sidecar) are never memoized as the conversion result.
+    r.raise_for_status()
 
     if r.headers and 'content-type' in r.headers:
         mimetype = r.headers['content-type']
@@ -40,8 +66,20 @@ def convert_str(data_str, input_format, output_format, extra_options=None):
     return r.text, mimetype
 
 
+# Formats Open Babel can read directly, so the InChI can be generated
+# in a single conversion call with no intermediate sdf.
+inchi_input_formats = frozenset(['smi', 'smiles', 'inchi', 'pdb', 'sdf',
+                                 'xyz'])
+
+
 def to_inchi(data_str, input_format):
 
+    # Formats Open Babel cannot read (e.g. cjson) go through avogadro
+    # once to produce an sdf it can.
+    if input_format not in inchi_input_formats:
+        data_str = avo_convert_str(data_str, input_format, 'sdf')
+        input_format = 'sdf'
+
     result, mime = convert_str(data_str, input_format, 'inchi')
     result = json.loads(result)
 
@@ -75,7 +113,7 @@ def properties(data_str, input_format, add_hydrogens=True):
         'addHydrogens': add_hydrogens
     }
 
-    r = requests.post(url, json=data)
+    r = session.post(url, json=data)
 
     return r.json()
 
@@ -1,6 +1,8 @@
 from pyparsing import *
+import copy
 import string
 import re
+from functools import lru_cache
 
 #
 # This module contains a parser for a simple query language that can encode
@@ -224,6 +226,14 @@ _key_map = {
 # main function used by external modules to convert query into dict that can
 # be used with pymongo find function.
 def to_mongo_query(query):
+    # Parsing is pure, so cache on the query string. Callers may add
+    # clauses to the dict they get back (e.g. permission filters), so
+    # hand out a copy rather than the cached instance.
+    return copy.deepcopy(_to_mongo_query(query))
+
+
+@lru_cache(maxsize=1024)
+def _to_mongo_query(query):
 
     try:
         result = boolean_expression.parseString(query, parseAll=True)
@@ -237,11 +247,8 @@ def to_mongo_query(query):
         q = result[0].query()
 
         for (key, value) in _key_map.items():
-            print(key)
             _replace_key(q, key, value)
 
-        print(q)
-
         return q
     except ParseException:
         raise InvalidQuery(query)
@@ -4,7 +4,7 @@ from rdflib.namespace import RDF, OWL, NamespaceManager
 import requests
 import argparse
 import json
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 from . import element
 
 gc = Namespace('http://purl.org/gc/#')
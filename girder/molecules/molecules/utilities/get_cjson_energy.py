@@ -1,4 +1,4 @@
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 
 
 def get_cjson_energy(cjson):
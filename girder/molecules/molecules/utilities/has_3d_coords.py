@@ -1,4 +1,4 @@
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 
 
 def cjson_has_3d_coords(cjson):
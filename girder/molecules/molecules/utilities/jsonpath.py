@@ -0,0 +1,11 @@
+from functools import lru_cache
+
+from jsonpath_rw import parse as _parse
+
+
+# jsonpath_rw rebuilds its parser state on every parse() call, which
+# is expensive. The expressions used in this plugin are a small fixed
+# set, so compile each one once and reuse it.
+@lru_cache(maxsize=None)
+def parse(expression):
+    return _parse(expression)
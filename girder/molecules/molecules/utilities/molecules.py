@@ -1,7 +1,7 @@
 import json
 import requests
 
-from jsonpath_rw import parse
+from molecules.utilities.jsonpath import parse
 
 from .. import avogadro
 from .. import openbabel
@@ -76,6 +76,9 @@ def create_molecule(data_str, input_format, user, public, gen3d=True,
             'inchikey': inchikey,
             'smiles': smiles,
             'properties': props,
+            # Cache the atom count on the document so endpoints that
+            # need it don't have to invoke avogadro/openbabel again.
+            'atomCount': props.get('atomCount'),
             'atomCounts': atomCounts,
             'provenance': provenance
         }
@@ -1,5 +1,9 @@
+import functools
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from bson.objectid import ObjectId, InvalidId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from girder import logger
 from girder.constants import AccessType
 from girder.models.model_base import AccessControlledModel
@@ -11,6 +15,42 @@ import cumulus
 from cumulus.taskflow import load_class, TaskFlowState
 from taskflow.models.taskflow import Taskflow as TaskflowModel
 
+# Resolving a taskflow class from its fully qualified name walks the
+# import system every time; the result never changes for a given name,
+# so memoize it.
+_load_class = functools.lru_cache(maxsize=256)(load_class)
+
+
+# Listing endpoints pass the same owner id string over and over; skip
+# re-validating and re-parsing the 24-char hex on every call.
+@functools.lru_cache(maxsize=2048)
+def _to_oid(s):
+    return ObjectId(s)
+
+
+# Instantiating a Girder model re-runs its initialization (index
+# bookkeeping included), so keep singletons for the models used on the
+# scheduling path instead of constructing one per call. Created lazily:
+# models can't be built until Girder itself is initialized.
+@functools.lru_cache(maxsize=1)
+def _taskflow_model():
+    return TaskflowModel()
+
+
+@functools.lru_cache(maxsize=1)
+def _queue_model():
+    return Queue()
+
+
+# Flush size for batch enqueues; keeps any single update document well
+# below the BSON ceiling no matter how large the submitted batch is.
+ADD_MANY_BATCH_SIZE = 500
+
+
+def _chunks(items, n):
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
 TASKFLOW_NON_RUNNING_STATES = [
     TaskFlowState.CREATED,
     TaskFlowState.COMPLETE,
@@ -29,22 +69,94 @@ class TaskStatus(object):
     PENDING = 'pending'
     RUNNING = 'running'
 
+
+def _fifo_pop_exprs():
+    # FIFO takes from the head of pending.
+    popped = {'$slice': ['$pending', '$_take']}
+    remaining = {'$slice': ['$pending', '$_take',
+                            {'$add': [{'$size': '$pending'}, 1]}]}
+    return popped, remaining
+
+
+def _lifo_pop_exprs():
+    # LIFO takes from the tail (newest first, hence the reverse).
+    popped = {
+        '$reverseArray': {
+            '$slice': ['$pending', {'$multiply': [-1, '$_take']}]
+        }
+    }
+    n_left = {'$subtract': [{'$size': '$pending'}, '$_take']}
+    remaining = {
+        '$cond': [{'$gt': [n_left, 0]},
+                  {'$slice': ['$pending', n_left]},
+                  []]
+    }
+    return popped, remaining
+
+
+# A queue's type never changes, so the pop expressions are fixed per
+# type; build them once instead of re-branching and re-building the
+# dicts on every pop.
+_POP_EXPRS = {
+    QueueType.FIFO: _fifo_pop_exprs(),
+    QueueType.LIFO: _lifo_pop_exprs()
+}
+
 class Queue(AccessControlledModel):
 
     def initialize(self):
         self.name = 'queues'
         self.ensureIndices(['name'])
+        # Queue names are unique per owner; enforcing that with a
+        # unique compound index makes the duplicate probe in validate an
+        # index lookup and guards against races the probe can miss.
+        self.ensureIndex(([('userId', 1), ('name', 1)], {'unique': True}))
+        # Backs the server-side ACL clause used by findWithPermissions.
+        self.ensureIndex('access.users.id')
+        self.ensureIndex('taskflows.id')
+        # No partial "pop ready" index: pops always target a single
+        # queue by _id, so the pending.0 / nRunning predicates only
+        # ever filter one document. Entries leave `taskflows` when they
+        # finish, so there is nothing for a TTL index to expire either.
         self.mutable_props = ['maxRunning']
 
     def validate(self, queue):
         name = queue['name']
         userId = queue['userId']
-        # Do we already have this name?
+        # Do we already have this name? An indexed existence probe, so
+        # no documents are transferred or decoded.
         if queue.get('_id') is None:
-            if len(list(self.find(name=name, owner=userId, force=True))) > 0:
+            count = self.collection.count_documents(
+                {'userId': userId, 'name': name}, limit=1)
+            if count > 0:
                 raise ValidationException('"%s" has already been taken.' % name, field='name')
         return queue
 
+    def load(self, *args, **kwargs):
+        queue = super(Queue, self).load(*args, **kwargs)
+        return self._migrate_taskflows(queue)
+
+    def _migrate_taskflows(self, queue):
+        # Queues written before taskflows became an array store it as a
+        # dict keyed by stringified taskflow id. Upconvert lazily on
+        # read and persist the result, so the array-based updates
+        # ($push, $pull, arrayFilters) work against legacy documents.
+        if queue is None or not isinstance(queue.get('taskflows'), dict):
+            return queue
+
+        entries = [{'id': ObjectId(tf_id), 'status': status}
+                   for tf_id, status in queue['taskflows'].items()]
+        queue['taskflows'] = entries
+
+        # Guard on the stored type so we never clobber an array another
+        # request converted (and possibly updated) in the meantime.
+        self.collection.update_one(
+            {'_id': queue['_id'],
+             'taskflows': {'$not': {'$type': 'array'}}},
+            {'$set': {'taskflows': entries}})
+
+        return queue
+
     def find(self, name=None, owner=None, offset=0, limit=None, sort=None, user=None, force=False):
         query = {}
 
@@ -54,32 +166,37 @@ class Queue(AccessControlledModel):
         if owner is not None:
             if not isinstance(owner, ObjectId):
                 try:
-                    owner = ObjectId(owner)
+                    owner = _to_oid(str(owner))
                 except InvalidId:
                     raise ValidationException('Invalid ObjectId: %s' % owner,
                                               field='owner')
             query['userId'] = owner
 
-        cursor = super(Queue, self).find(query=query, sort=sort, user=user)
+        if force:
+            return super(Queue, self).find(query=query, offset=offset,
+                                           limit=limit or 0, sort=sort)
 
-        if not force:
-            for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                    level=AccessType.READ,
-                                                    limit=limit, offset=offset):
-                yield r
-        else:
-            for r  in cursor:
-                yield r
+        # Push the ACL predicate into the query itself so the server
+        # only returns documents the user can read, instead of decoding
+        # every candidate in Python and discarding the invisible ones.
+        return self.findWithPermissions(query, offset=offset,
+                                        limit=limit or 0, sort=sort,
+                                        user=user, level=AccessType.READ)
 
     def create(self, name, type_, max_running, user=None):
 
+        # taskflows is an array of {id, status} subdocuments rather
+        # than a dict keyed by taskflow id: dotted-path updates on
+        # arbitrary keys can't be indexed and rewrite the whole
+        # subdocument, while array entries can be matched by the
+        # multikey taskflows.id index and updated in place.
         queue = {
             'name': name,
             'type': type_,
             'nRunning': 0,
             'maxRunning': max_running,
             'pending': [],
-            'taskflows': {}
+            'taskflows': []
         }
 
         userId = None
@@ -90,7 +207,13 @@ class Queue(AccessControlledModel):
 
         self.setUserAccess(queue, user=user, level=AccessType.ADMIN)
 
-        return self.save(queue)
+        try:
+            return self.save(queue)
+        except DuplicateKeyError:
+            # Two concurrent creates can both pass the validate probe;
+            # the unique index is the authoritative check.
+            raise ValidationException('"%s" has already been taken.' % name,
+                                      field='name')
 
     def apply_updates(self, queue, model_updates, user):
         query = {
@@ -104,16 +227,23 @@ class Queue(AccessControlledModel):
                 updates.setdefault('$set', {})[prop] = model_updates[prop]
 
         if updates:
-            super(Queue, self).update(query, updates, multi=False)
-            queue = self.load(queue['_id'], user=user, level=AccessType.READ)
+            # Fetch the post-image in the same round trip rather than
+            # re-loading (and re-running the ACL check) afterwards; the
+            # caller has already been granted access to this queue.
+            queue = self.collection.find_one_and_update(
+                query, updates, return_document=ReturnDocument.AFTER)
 
         return queue
 
     def add(self, queue, taskflow, params, user):
         query = {
             '_id': queue['_id'],
-            'taskflows.%s' % taskflow['_id']: {
-                '$exists': False
+            'taskflows': {
+                '$not': {
+                    '$elemMatch': {
+                        'id': taskflow['_id']
+                    }
+                }
             }
         }
 
@@ -122,127 +252,219 @@ class Queue(AccessControlledModel):
             'startParams': params
         }
 
-        if queue['type'] == QueueType.FIFO:
-            push = {
-                'pending': payload
-            }
-        else:
-            push = {
-                'pending': {
-                    '$each': [ payload ],
-                    '$position': 0
+        # Always append: a $position 0 prepend makes the server shift
+        # the whole array on every enqueue. The queue type is fixed for
+        # the lifetime of the queue, so the pop side picks the right
+        # end instead (head for FIFO, tail for LIFO).
+        updates = {
+            '$push': {
+                'pending': payload,
+                'taskflows': {
+                    'id': taskflow['_id'],
+                    'status': TaskStatus.PENDING
                 }
             }
+        }
+        # The post-image comes back with the update itself; no need for
+        # a second read plus ACL check. If the guard didn't match (the
+        # taskflow is already queued) the queue is unchanged.
+        updated = self.collection.find_one_and_update(
+            query, updates, return_document=ReturnDocument.AFTER)
+        if updated is not None:
+            queue = updated
+        return queue
 
-        updates = {
-            '$push': push,
-            '$set': {
-                'taskflows.%s' % taskflow['_id']: TaskStatus.PENDING
+    def add_many(self, queue, taskflows, params_list, user):
+        # Enqueue a whole batch with one update: a single $push with
+        # $each for both the payloads and the status entries, instead
+        # of one round trip per task. Tasks already in the queue are
+        # skipped, mirroring the guard in add().
+        queued = {entry['id'] for entry in queue['taskflows']}
+
+        payloads = []
+        entries = []
+        for taskflow, params in zip(taskflows, params_list):
+            if taskflow['_id'] in queued:
+                continue
+            queued.add(taskflow['_id'])
+            payloads.append({
+                'taskflowId': taskflow['_id'],
+                'startParams': params
+            })
+            entries.append({
+                'id': taskflow['_id'],
+                'status': TaskStatus.PENDING
+            })
+
+        if not payloads:
+            return queue
+
+        # Flush in fixed-size chunks so a huge submission neither
+        # builds one mega update document in memory nor risks the 16MB
+        # BSON limit on the update itself.
+        updated = None
+        for payload_chunk, entry_chunk in zip(
+                _chunks(payloads, ADD_MANY_BATCH_SIZE),
+                _chunks(entries, ADD_MANY_BATCH_SIZE)):
+            updates = {
+                '$push': {
+                    'pending': {'$each': payload_chunk},
+                    'taskflows': {'$each': entry_chunk}
+                }
             }
-        }
-        self.update(query, updates)
-        queue = self.load(queue['_id'], user=user, level=AccessType.READ)
+
+            updated = self.collection.find_one_and_update(
+                {'_id': queue['_id']}, updates,
+                return_document=ReturnDocument.AFTER)
+
+        if updated is not None:
+            queue = updated
         return queue
 
     def pop(self, queue, limit, user):
         queue, popped = self._pop_many(queue, limit, user)
 
-        for task in popped:
-            self._start_taskflow(queue['_id'], task['taskflowId'], task['start_params'], user)
+        if popped:
+            # One token covers the whole batch, and each start is
+            # blocking I/O against remote services, so fan the starts
+            # out over a pool instead of running them back to back.
+            token = ModelImporter.model('token').createToken(user=user,
+                                                             days=7)
+            if len(popped) == 1:
+                task = popped[0]
+                self._start_taskflow(queue['_id'], task['taskflowId'],
+                                     task['startParams'], user, token)
+            else:
+                with ThreadPoolExecutor(
+                        max_workers=min(len(popped), 16)) as executor:
+                    futures = [
+                        executor.submit(self._start_taskflow, queue['_id'],
+                                        task['taskflowId'],
+                                        task['startParams'], user, token)
+                        for task in popped
+                    ]
+                    for future in futures:
+                        future.result()
 
         return queue
 
     def finish(self, queue, taskflow, user):
         query = {
             '_id': queue['_id'],
-            'taskflows.%s' % taskflow['_id']: TaskStatus.RUNNING
+            'taskflows': {
+                '$elemMatch': {
+                    'id': taskflow['_id'],
+                    'status': TaskStatus.RUNNING
+                }
+            }
         }
 
         updates = {
             '$inc': {
                 'nRunning': -1
             },
-            '$unset': {
-                'taskflows.%s' % taskflow['_id']: ""
+            '$pull': {
+                'taskflows': {
+                    'id': taskflow['_id']
+                }
             }
         }
 
-        self.update(query, updates)
-        queue = self.load(queue['_id'], user=user, level=AccessType.READ)
+        # As in add(), take the post-image from the update itself. If
+        # the guard didn't match (the taskflow isn't running in this
+        # queue) the queue is unchanged.
+        updated = self.collection.find_one_and_update(
+            query, updates, return_document=ReturnDocument.AFTER)
+        if updated is not None:
+            queue = updated
         return queue
 
-    def _pop_one(self, queue, user):
-        max_running = queue['maxRunning']
-
-        if max_running == 0:
-            max_running = sys.maxsize
+    def _pop_many(self, queue, limit, user):
+        # maxRunning == 0 means unlimited; resolving that server-side
+        # keeps the capacity check authoritative even if maxRunning is
+        # changed concurrently, rather than baking a possibly stale
+        # client-side value into the query.
+        effective_max = {
+            '$cond': [{'$eq': ['$maxRunning', 0]}, sys.maxsize,
+                      '$maxRunning']
+        }
 
         query = {
             '_id': queue['_id'],
-            'nRunning': {
-                '$lt': max_running
-            },
-            '$where': 'this.pending.length > 0'
-        }
-
-        updates = {
-            '$inc': {
-                'nRunning': 1
+            '$expr': {
+                '$lt': ['$nRunning', effective_max]
             },
-            '$pop': {
-                'pending': -1
+            # Pure BSON check that the array is non-empty; a $where JS
+            # predicate here would spin up the server's JS engine for
+            # every candidate document.
+            'pending.0': {
+                '$exists': True
             }
         }
 
-        # queue is the document BEFORE the updates
-        queue = self.collection.find_one_and_update(query, updates)
-        taskflow_id = None
-        start_params = None
-
-        if queue is None:
-            return queue, taskflow_id, start_params
-
-        n_running = queue['nRunning']
-        pending = queue['pending']
-        if (n_running >= max_running or len(pending) == 0):
-            return queue, taskflow_id, start_params
-
-        task = pending.pop(0)
-        taskflow_id = task['taskflowId']
-        start_params = task['startParams']
-
-        query = {
-            '_id': queue['_id']
+        # Pop up to `limit` tasks in a single atomic update: an
+        # aggregation-pipeline update computes how many run slots are
+        # free, moves that many tasks out of `pending` into a transient
+        # `_popped` field and bumps `nRunning`, all server-side. Tasks
+        # are always appended in add(), so FIFO pops from the head of
+        # the array and LIFO from the tail (newest first).
+        take = {
+            '$min': [
+                limit,
+                {'$subtract': [effective_max, '$nRunning']},
+                {'$size': '$pending'}
+            ]
         }
 
-        updates = {
-            '$set': {
-                'taskflows.%s' % taskflow_id: TaskStatus.RUNNING
-            }
-        }
-
-        self.update(query, updates)
-        queue = self.load(queue['_id'], user=user, level=AccessType.READ)
-
-        return queue, taskflow_id, start_params
-
-    def _pop_many(self, queue, limit, user):
-        popped = []
-        queue_, taskflow_id, start_params = self._pop_one(queue, user)
-        while taskflow_id is not None and len(popped) < limit:
-            queue = queue_
-            popped.append({'taskflowId': taskflow_id, 'start_params': start_params})
-            queue_, taskflow_id, start_params = self._pop_one(queue, user)
+        popped_expr, remaining_expr = _POP_EXPRS[queue['type']]
+
+        updates = [
+            {'$set': {'_take': take}},
+            {'$set': {
+                '_popped': popped_expr,
+                'pending': remaining_expr,
+                'nRunning': {'$add': ['$nRunning', '$_take']}
+            }},
+            {'$unset': '_take'}
+        ]
+
+        # Only the popped tasks are needed from this update; without the
+        # projection the whole remaining pending array comes back over
+        # the wire just to be thrown away, so deep queues would pay
+        # O(depth) transfer per pop.
+        queue_ = self.collection.find_one_and_update(
+            query, updates, projection={'_popped': 1},
+            return_document=ReturnDocument.AFTER)
+
+        if queue_ is None:
+            # Nothing to pop (empty queue or no free run slots)
+            return queue, []
+
+        popped = queue_.pop('_popped', [])
+
+        # Mark all the popped tasks as running in one update, and drop
+        # the transient `_popped` field while we are at it.
+        popped_ids = [task['taskflowId'] for task in popped]
+
+        queue = self.collection.find_one_and_update(
+            {'_id': queue['_id']},
+            {'$set': {'taskflows.$[elem].status': TaskStatus.RUNNING},
+             '$unset': {'_popped': ''}},
+            array_filters=[{'elem.id': {'$in': popped_ids}}],
+            return_document=ReturnDocument.AFTER)
 
         return queue, popped
 
-    def _start_taskflow(self, queue_id, taskflow_id, params, user):
+    def _start_taskflow(self, queue_id, taskflow_id, params, user,
+                        token=None):
         taskflow = {"_id": taskflow_id}
         updates = {"meta": {"queueId": queue_id}}
-        taskflow = TaskflowModel().update_taskflow(user, taskflow, updates)
+        taskflow = _taskflow_model().update_taskflow(user, taskflow, updates)
 
-        constructor = load_class(taskflow['taskFlowClass'])
-        token = ModelImporter.model('token').createToken(user=user, days=7)
+        constructor = _load_class(taskflow['taskFlowClass'])
+        if token is None:
+            token = ModelImporter.model('token').createToken(user=user,
+                                                             days=7)
 
         workflow = constructor(
             id=str(taskflow['_id']),
@@ -258,18 +480,22 @@ class Queue(AccessControlledModel):
         return workflow
 
 def cleanup_failed_taskflows():
-    queues = list(Queue().find(limit=sys.maxsize, force=True))
+    queues = list(_queue_model().find(limit=sys.maxsize, force=True))
     for queue in queues:
+        # find() doesn't go through load(), so upconvert any legacy
+        # dict-typed taskflows here before iterating the entries.
+        queue = _queue_model()._migrate_taskflows(queue)
         user = UserModel().load(queue['userId'], force=True)
         if user is None:
             continue
 
-        for taskflow_id, status in queue['taskflows'].items():
-            if status == TaskStatus.RUNNING:
-                taskflow = TaskflowModel().load(taskflow_id, force=True)
+        for entry in queue['taskflows']:
+            if entry['status'] == TaskStatus.RUNNING:
+                taskflow_id = entry['id']
+                taskflow = _taskflow_model().load(taskflow_id, force=True)
                 if taskflow['status'] in TASKFLOW_NON_RUNNING_STATES:
                     logger.warning("Removing non-running taskflow {} from the queue {}".format(taskflow_id, queue["_id"]))
-                    Queue().finish(queue, taskflow, user)
+                    _queue_model().finish(queue, taskflow, user)
 
 def on_taskflow_status_update(event):
     taskflow = event.info['taskflow']
@@ -278,7 +504,7 @@ def on_taskflow_status_update(event):
         return
 
     if taskflow['status'] in TASKFLOW_NON_RUNNING_STATES:
-        queue = Queue().load(queue_id, force=True)
+        queue = _queue_model().load(queue_id, force=True)
         user = UserModel().load(queue['userId'], force=True)
-        Queue().finish(queue, taskflow, user)
-        Queue().pop(queue, sys.maxsize, user)
+        _queue_model().finish(queue, taskflow, user)
+        _queue_model().pop(queue, sys.maxsize, user)
@@ -26,6 +26,7 @@ class Queue(Resource):
         self.route('GET', (':id', ), self.find_id)
         self.route('DELETE', (':id', ), self.remove)
         self.route('PUT', (':id', ), self.set_max_running)
+        self.route('PUT', (':id', 'add'), self.add_tasks)
         self.route('PUT', (':id', 'add', ':taskflowId'), self.add_task)
         self.route('PUT', (':id', 'pop'), self.pop_task)
         self.route('GET', (':id', 'taskflows'), self.get_tasks)
@@ -113,6 +114,38 @@ class Queue(Resource):
         queue = QueueModel().add(queue, taskflow, body, self.getCurrentUser())
         return queue
 
+    @access.user(scope=TokenScope.DATA_WRITE)
+    @autoDescribeRoute(
+        Description('Add multiple taskflows to the queue in one request.')
+        .modelParam('id', 'The queue id',
+                    model=QueueModel, destName='queue',
+                    level=AccessType.WRITE, paramType='path')
+        .jsonParam('body', 'A list of {"taskflowId", "params"} objects',
+                   paramType='body')
+    )
+    def add_tasks(self, queue, body):
+        if not isinstance(body, list):
+            raise RestException('A list of tasks is required.')
+
+        user = self.getCurrentUser()
+        taskflows = []
+        params_list = []
+        for item in body:
+            if 'taskflowId' not in item:
+                raise RestException('taskflowId is required for each task.')
+
+            taskflow = TaskflowModel().load(item['taskflowId'], user=user,
+                                            level=AccessType.WRITE)
+            if taskflow is None:
+                raise RestException(
+                    'Invalid taskflow id (%s).' % item['taskflowId'],
+                    code=400)
+            taskflows.append(taskflow)
+            params_list.append(item.get('params'))
+
+        queue = QueueModel().add_many(queue, taskflows, params_list, user)
+        return queue
+
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
         Description('Pop a task from the queue if there are availabe run slots')
@@ -167,11 +200,11 @@ class Queue(Resource):
         include_pending = status in [TaskStatus.PENDING, '']
         include_running = status in [TaskStatus.RUNNING, '']
 
-        for taskflow_id, taskflow_status in queue['taskflows'].items():
-            if taskflow_status == TaskStatus.PENDING and include_pending:
-                pending_ids.append(taskflow_id)
-            elif taskflow_status == TaskStatus.RUNNING and include_running:
-                running_ids.append(taskflow_id)
+        for entry in queue['taskflows']:
+            if entry['status'] == TaskStatus.PENDING and include_pending:
+                pending_ids.append(entry['id'])
+            elif entry['status'] == TaskStatus.RUNNING and include_running:
+                running_ids.append(entry['id'])
 
         query = {
             '_id': {